@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+import audioop
+
+import numpy as np
+
+ULAW_LUT = np.frombuffer(audioop.ulaw2lin(bytes(range(256)), 2), dtype=np.int16)
+
+HB_TAPS = 8
+_hb_offsets = np.arange(HB_TAPS) - (HB_TAPS - 1) / 2
+_hb = np.sinc(_hb_offsets) * np.hamming(HB_TAPS)
+# Q15 odd-phase coefficients of a half-band interpolator; the even phase is a pure delay.
+HALFBAND_ODD = np.round(32768 * _hb / _hb.sum()).astype(np.int32)
+HB_DELAY = HB_TAPS // 2 - 1
+
+
+def decode_upsample(audio: bytes, tail: np.ndarray, out: np.ndarray) -> np.ndarray:
+  pcm8k = ULAW_LUT[np.frombuffer(audio, dtype=np.uint8)]
+  padded = np.concatenate([tail, pcm8k])
+  mids = np.convolve(padded.astype(np.int32), HALFBAND_ODD, "valid") >> 15
+  np.clip(mids, -32768, 32767, out=mids)
+  out[0::2] = padded[HB_DELAY : HB_DELAY + pcm8k.shape[0]]
+  out[1::2] = mids
+  return padded[-(HB_TAPS - 1) :]
@@ -3,25 +3,35 @@ from __future__ import annotations
 import asyncio
 import base64
 import functools
+import hashlib
 import json
 import logging
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager
 from array import array
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+from urllib.parse import quote
 
-import audioop
 import google.generativeai as genai
 import httpx
+import numpy as np
+import orjson
 import pvcheetah
+import pybase64
+from audio_kernels import HB_TAPS, decode_upsample
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_validator
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
@@ -42,76 +52,146 @@ FIREBASE_DB_SECRET = os.getenv("FIREBASE_DB_SECRET")
 CALENDAR_ID = os.getenv("CALENDAR_ID")
 SERVICE_INFO = os.getenv("GOOGLE_SERVICE_ACCOUNT_INFO")
 SERVICE_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+SILENCE_MEAN_ABS = int(os.getenv("SILENCE_MEAN_ABS", "0"))
 
-HTTP = httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=5.0))
+HTTP = httpx.AsyncClient(
+  http2=True,
+  timeout=httpx.Timeout(10.0, connect=5.0),
+  limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0),
+)
 FIREBASE_PARAMS = {"auth": FIREBASE_DB_SECRET} if FIREBASE_DB_SECRET else None
 
+GCAL_EXEC = ThreadPoolExecutor(max_workers=int(os.getenv("GCAL_WORKERS", "4")), thread_name_prefix="gcal")
+CHEETAH_EXEC = ThreadPoolExecutor(max_workers=int(os.getenv("CHEETAH_WORKERS", "8")), thread_name_prefix="cheetah")
+
+
+_LAST_ISO: tuple[float, str] = (0.0, "")
+
 
 def iso_now() -> str:
-  return datetime.now(timezone.utc).isoformat()
+  global _LAST_ISO
+  now = time.time()
+  if 0 <= now - _LAST_ISO[0] < 0.05:
+    return _LAST_ISO[1]
+  stamp = datetime.fromtimestamp(now, timezone.utc).isoformat()
+  _LAST_ISO = (now, stamp)
+  return stamp
 
 
-async def fb(path: str, payload: dict) -> None:
-  url = f"{FIREBASE_RTDB_URL}/{path}.json"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+async def fb_url(url: str, payload: dict) -> None:
   try:
-    response = await HTTP.patch(url, json=payload, params=FIREBASE_PARAMS)
+    response = await HTTP.patch(url, content=orjson.dumps(payload), headers=JSON_HEADERS, params=FIREBASE_PARAMS)
     response.raise_for_status()
   except httpx.HTTPError as exc:  # pragma: no cover
-    LOGGER.warning("Firebase PATCH %s failed: %s", path, exc)
+    LOGGER.warning("Firebase PATCH %s failed: %s", url, exc)
+
+
+async def fb(path: str, payload: dict) -> None:
+  await fb_url(f"{FIREBASE_RTDB_URL}/{path}.json", payload)
 
 
 genai.configure(api_key=GEMINI_API_KEY)
-MODEL = genai.GenerativeModel("gemini-1.5-flash")
 PROMPT = (
   "Summarize this phone call for a receptionist. Reply with JSON containing summary, sentiment (positive|neutral|negative), "
   "urgency (low|medium|high), and action_items (array of strings)."
 )
+MODEL = genai.GenerativeModel(
+  "gemini-1.5-flash",
+  system_instruction=PROMPT,
+  generation_config={"response_mime_type": "application/json"},
+)
 DEFAULT_CARD = {"summary": "Waiting for enough transcript…", "sentiment": "neutral", "urgency": "medium", "action_items": []}
+AI_CARD_MIN_DELTA = int(os.getenv("AI_CARD_MIN_DELTA", "120"))
+AI_MIN_INTERVAL = float(os.getenv("AI_MIN_INTERVAL", "8.0"))
+AI_REFRESH_AFTER = float(os.getenv("AI_REFRESH_AFTER", "15.0"))
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "4000"))
+
+CARD_CACHE_SIZE = 512
+_CARD_CACHE: OrderedDict[bytes, dict] = OrderedDict()
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL)
+_FALLBACK_CARD_REST = {k: v for k, v in DEFAULT_CARD.items() if k != "summary"}
 
 
 async def build_card(transcript: str) -> Optional[dict]:
   text = transcript.strip()
   if not text:
     return None
+  key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+  cached = _CARD_CACHE.get(key)
+  if cached is not None:
+    _CARD_CACHE.move_to_end(key)
+    return dict(cached)
 
-  def _invoke() -> dict:
-    try:
-      result = MODEL.generate_content([PROMPT, text])
-    except Exception as exc:  # pragma: no cover
-      LOGGER.warning("Gemini call failed: %s", exc)
-      return dict(DEFAULT_CARD)
+  try:
+    result = await MODEL.generate_content_async(text)
     raw = (result.text or "").strip()
-    if raw.startswith("```"):
-      raw = "\n".join(line for line in raw.splitlines()[1:] if not line.startswith("```"))
-    try:
-      parsed = json.loads(raw)
-      if isinstance(parsed, dict):
-        return parsed
-    except json.JSONDecodeError:
-      LOGGER.warning("Gemini returned non-JSON payload: %s", raw)
-    return {"summary": raw or DEFAULT_CARD["summary"], **{k: v for k, v in DEFAULT_CARD.items() if k != "summary"}}
-
-  return await asyncio.to_thread(_invoke)
+  except Exception as exc:  # pragma: no cover
+    LOGGER.warning("Gemini call failed: %s", exc)
+    return dict(DEFAULT_CARD)
+  match = _FENCE_RE.match(raw)
+  if match:
+    raw = match.group(1)
+  card: Optional[dict] = None
+  try:
+    parsed = orjson.loads(raw)
+    if isinstance(parsed, dict):
+      card = parsed
+  except orjson.JSONDecodeError:
+    LOGGER.warning("Gemini returned non-JSON payload: %s", raw)
+  if card is None:
+    card = {"summary": raw or DEFAULT_CARD["summary"], **_FALLBACK_CARD_REST}
+  _CARD_CACHE[key] = dict(card)
+  if len(_CARD_CACHE) > CARD_CACHE_SIZE:
+    _CARD_CACHE.popitem(last=False)
+  return card
 
 
 class CheetahStream:
-  def __init__(self) -> None:
-    self.engine = pvcheetah.create(access_key=CHEETAH_ACCESS_KEY, enable_automatic_punctuation=True)
-    self.frame_bytes = self.engine.frame_length * 2
-    self.buffer = bytearray()
-    self.state = None
-
-  def process(self, payload: str):
-    audio = base64.b64decode(payload)
-    linear = audioop.ulaw2lin(audio, 2)
-    pcm, self.state = audioop.ratecv(linear, 2, 1, 8000, 16000, self.state)
-    self.buffer.extend(pcm)
-    while len(self.buffer) >= self.frame_bytes:
-      chunk = bytes(self.buffer[: self.frame_bytes])
-      del self.buffer[: self.frame_bytes]
-      text, endpoint = self.engine.process(array("h", chunk))
+  def __init__(self, engine: pvcheetah.Cheetah) -> None:
+    self.engine = engine
+    self.frame_length = self.engine.frame_length
+    self._scratch = np.empty(self.frame_length * 8, dtype=np.int16)
+    self._frame = array("h", bytes(self.frame_length * 2))
+    self._frame_mv = memoryview(self._frame)
+    self._read = 0
+    self._write = 0
+    self._tail = np.zeros(HB_TAPS - 1, dtype=np.int16)
+    self._voiced = False
+    self.inflight: Optional[Future] = None
+
+  def process(self, payloads: list[str]):
+    audio = b"".join(pybase64.b64decode(payload, validate=False) for payload in payloads)
+    count = len(audio)
+    if not count:
+      return
+    needed = self._write + count * 2
+    if needed > self._scratch.shape[0]:
+      live = self._write - self._read
+      self._scratch[:live] = self._scratch[self._read : self._write]
+      self._read = 0
+      self._write = live
+      needed = live + count * 2
+      if needed > self._scratch.shape[0]:
+        self._scratch = np.concatenate([self._scratch, np.empty(needed, dtype=np.int16)])
+    self._tail = decode_upsample(audio, self._tail, self._scratch[self._write : needed])
+    self._write = needed
+    while self._write - self._read >= self.frame_length:
+      frame = self._scratch[self._read : self._read + self.frame_length]
+      self._read += self.frame_length
+      if SILENCE_MEAN_ABS:
+        quiet = int(np.abs(frame, dtype=np.int32).mean()) < SILENCE_MEAN_ABS
+        if quiet and not self._voiced:
+          continue
+        if not quiet:
+          self._voiced = True
+      self._frame_mv[:] = frame
+      text, endpoint = self.engine.process(self._frame)
       text = text.strip()
       if endpoint:
+        self._voiced = False
         flushed = self.engine.flush().strip()
         combined = " ".join(part for part in (text, flushed) if part).strip()
         if combined:
@@ -121,47 +201,192 @@ class CheetahStream:
 
   def close(self) -> Optional[str]:
     text = self.engine.flush().strip()
-    self.engine.delete()
     return text or None
 
 
+def _new_engine() -> pvcheetah.Cheetah:
+  return pvcheetah.create(access_key=CHEETAH_ACCESS_KEY, enable_automatic_punctuation=True)
+
+
+class CheetahPool:
+  def __init__(self, size: int) -> None:
+    self.size = size
+    self._engines: asyncio.Queue[pvcheetah.Cheetah] = asyncio.Queue()
+
+  async def start(self) -> None:
+    loop = asyncio.get_running_loop()
+    for _ in range(self.size):
+      self._engines.put_nowait(await loop.run_in_executor(CHEETAH_EXEC, _new_engine))
+
+  async def acquire(self) -> pvcheetah.Cheetah:
+    return await self._engines.get()
+
+  def release(self, engine: pvcheetah.Cheetah) -> None:
+    self._engines.put_nowait(engine)
+
+  async def recover(self, stream: CheetahStream, engine: pvcheetah.Cheetah) -> None:
+    # The stream died without a clean close: wait out any executor call still
+    # feeding the engine, then flush the open utterance so the next borrower
+    # can't transcribe this call's audio. A failed flush leaves the engine
+    # suspect, so replace it instead of pooling it.
+    loop = asyncio.get_running_loop()
+
+    def sanitize() -> None:
+      if stream.inflight is not None:
+        wait([stream.inflight])
+      engine.flush()
+
+    try:
+      await loop.run_in_executor(CHEETAH_EXEC, sanitize)
+    except Exception as exc:
+      LOGGER.warning("Replacing Cheetah engine after failed flush: %s", exc)
+      try:
+        engine.delete()
+      except Exception:  # pragma: no cover
+        pass
+      engine = await loop.run_in_executor(CHEETAH_EXEC, _new_engine)
+    self.release(engine)
+
+  def close(self) -> None:
+    while not self._engines.empty():
+      self._engines.get_nowait().delete()
+
+
+CHEETAH_POOL = CheetahPool(int(os.getenv("CHEETAH_POOL_SIZE", "4")))
+
+
+FLUSH_INTERVAL = 0.15
+MEDIA_BATCH_FRAMES = int(os.getenv("MEDIA_BATCH_FRAMES", "4"))
+
+
 class CallSession:
   def __init__(self, call_sid: str) -> None:
     self.call_sid = call_sid
-    self.final = ""
+    self._fb_url = f"{FIREBASE_RTDB_URL}/calls/{call_sid}.json"
+    self.final_parts: list[str] = []
+    self._final_cache: Optional[str] = None
     self.partial = ""
     self.ai_source = ""
-
-  async def push(self) -> None:
-    await fb(
-      f"calls/{self.call_sid}",
-      {"transcript": {"final": self.final, "partial": self.partial, "updatedAt": iso_now()}},
-    )
-
-  async def push_ai(self) -> None:
-    text = self.final.strip()
-    if not text or text == self.ai_source:
+    self._pending: dict = {}
+    self._flush_task: Optional[asyncio.Task] = None
+    self._ai_queue: asyncio.Queue[str] = asyncio.Queue(maxsize=1)
+    self._ai_worker: Optional[asyncio.Task] = None
+    self._ai_last = 0.0
+    self._payload_batch: list[str] = []
+    self._last_signature: Optional[int] = None
+
+  def append_final(self, text: str) -> None:
+    self.final_parts.append(text)
+    self._final_cache = None
+
+  def final_text(self) -> str:
+    if self._final_cache is None:
+      self._final_cache = " ".join(self.final_parts)
+    return self._final_cache
+
+  def stage(self, payload: dict) -> None:
+    self._pending.update(payload)
+    if self._flush_task is None or self._flush_task.done():
+      self._flush_task = asyncio.create_task(self._delayed_flush())
+
+  def push(self) -> None:
+    self.stage({"transcript": {"final": self.final_text(), "partial": self.partial}})
+
+  async def _delayed_flush(self) -> None:
+    while self._pending:
+      await asyncio.sleep(FLUSH_INTERVAL)
+      await self.flush()
+
+  async def flush(self) -> None:
+    if not self._pending:
+      return
+    payload, self._pending = self._pending, {}
+    signature = hash(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS))
+    if signature == self._last_signature:
       return
-    card = await build_card(text)
+    self._last_signature = signature
+    stamp = iso_now()
+    for key in ("transcript", "ai"):
+      if key in payload:
+        payload[key]["updatedAt"] = stamp
+    await fb_url(self._fb_url, payload)
+
+  def _ai_candidate(self) -> Optional[str]:
+    text = self.final_text().strip()
+    if not text or text == self.ai_source:
+      return None
+    if (
+      text.startswith(self.ai_source)
+      and len(text) - len(self.ai_source) < AI_CARD_MIN_DELTA
+      and time.monotonic() - self._ai_last < AI_REFRESH_AFTER
+    ):
+      return None
+    return text
+
+  async def _summarize(self, text: str) -> None:
+    card = await build_card(text[-MAX_PROMPT_CHARS:])
     if card:
       self.ai_source = text
-      await fb(f"calls/{self.call_sid}", {"ai": {"card": card, "updatedAt": iso_now()}})
+      self.stage({"ai": {"card": card}})
+
+  async def _ai_loop(self) -> None:
+    while True:
+      text = await self._ai_queue.get()
+      wait = self._ai_last + AI_MIN_INTERVAL - time.monotonic()
+      if wait > 0:
+        await asyncio.sleep(wait)
+        while not self._ai_queue.empty():
+          text = self._ai_queue.get_nowait()
+      await self._summarize(text)
+      self._ai_last = time.monotonic()
+
+  def request_ai(self) -> None:
+    text = self._ai_candidate()
+    if text is None:
+      return
+    if self._ai_worker is None:
+      self._ai_worker = asyncio.create_task(self._ai_loop())
+    if self._ai_queue.full():
+      self._ai_queue.get_nowait()
+    self._ai_queue.put_nowait(text)
+
+  async def push_ai(self) -> None:
+    text = self._ai_candidate()
+    if text is not None:
+      await self._summarize(text)
+
+  def close_ai(self) -> None:
+    if self._ai_worker is not None:
+      self._ai_worker.cancel()
 
   async def consume(self, stream: CheetahStream, payload: str) -> None:
-    for text, endpoint in stream.process(payload):
+    self._payload_batch.append(payload)
+    if len(self._payload_batch) >= MEDIA_BATCH_FRAMES:
+      await self.flush_media(stream)
+
+  async def flush_media(self, stream: CheetahStream) -> None:
+    if not self._payload_batch:
+      return
+    batch, self._payload_batch = self._payload_batch, []
+    stream.inflight = CHEETAH_EXEC.submit(lambda: list(stream.process(batch)))
+    results = await asyncio.wrap_future(stream.inflight)
+    stream.inflight = None
+    for text, endpoint in results:
       if endpoint:
-        self.final = (self.final + " " + text).strip()
+        self.append_final(text)
         self.partial = ""
-        await self.push()
-        await self.push_ai()
+        self.push()
+        self.request_ai()
       else:
         self.partial = text
-        await self.push()
+        self.push()
 
 
 class BookingRequest(BaseModel):
+  model_config = ConfigDict(str_strip_whitespace=True)
+
   callSid: str
-  startIso: str
+  startIso: datetime
   durationMinutes: int = 60
   customerName: Optional[str] = None
   customerPhone: Optional[str] = None
@@ -169,26 +394,55 @@ class BookingRequest(BaseModel):
   summary: Optional[str] = None
   transcript: Optional[str] = None
 
+  @field_validator("startIso", mode="before")
+  @classmethod
+  def _parse_start_iso(cls, value):
+    if isinstance(value, str):
+      return datetime.fromisoformat(value)
+    return value
+
+
+CALENDAR_SCOPES = ["https://www.googleapis.com/auth/calendar"]
+DESCRIPTION_LIMIT = 4000
+CALENDAR_EVENTS_URL = "https://www.googleapis.com/calendar/v3/calendars/{}/events"
+_TOKEN_LOCK = threading.Lock()
+
 
 @functools.lru_cache(maxsize=1)
-def calendar_service():
+def calendar_credentials() -> service_account.Credentials:
   if SERVICE_INFO and SERVICE_INFO.strip():
     raw = SERVICE_INFO.strip()
     if not raw.startswith("{"):
       raw = base64.b64decode(raw).decode("utf-8")
-    credentials = service_account.Credentials.from_service_account_info(
-      json.loads(raw), scopes=["https://www.googleapis.com/auth/calendar"]
-    )
-  elif SERVICE_FILE and os.path.exists(SERVICE_FILE):
-    credentials = service_account.Credentials.from_service_account_file(
-      SERVICE_FILE, scopes=["https://www.googleapis.com/auth/calendar"]
-    )
-  else:
-    raise RuntimeError("Google service account credentials are not configured")
-  return build("calendar", "v3", credentials=credentials, cache_discovery=False)
+    return service_account.Credentials.from_service_account_info(json.loads(raw), scopes=CALENDAR_SCOPES)
+  if SERVICE_FILE and os.path.exists(SERVICE_FILE):
+    return service_account.Credentials.from_service_account_file(SERVICE_FILE, scopes=CALENDAR_SCOPES)
+  raise RuntimeError("Google service account credentials are not configured")
+
+
+def calendar_token() -> str:
+  credentials = calendar_credentials()
+  with _TOKEN_LOCK:
+    if not credentials.valid:
+      credentials.refresh(GoogleAuthRequest())
+  return credentials.token
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  await CHEETAH_POOL.start()
+  try:
+    await HTTP.head(f"{FIREBASE_RTDB_URL}/.json", params=FIREBASE_PARAMS)
+  except httpx.HTTPError as exc:  # pragma: no cover
+    LOGGER.warning("Firebase warm-up failed: %s", exc)
+  yield
+  CHEETAH_POOL.close()
+  await HTTP.aclose()
+  for pool in (GCAL_EXEC, CHEETAH_EXEC):
+    pool.shutdown(wait=False)
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 
@@ -201,10 +455,7 @@ async def healthz() -> dict:
 async def create_booking(request: BookingRequest) -> JSONResponse:
   if not CALENDAR_ID:
     raise HTTPException(status_code=503, detail="Calendar is not configured")
-  try:
-    start = datetime.fromisoformat(request.startIso.replace("Z", "+00:00")).astimezone(timezone.utc)
-  except ValueError as exc:
-    raise HTTPException(status_code=400, detail="Invalid startIso") from exc
+  start = request.startIso.astimezone(timezone.utc)
   end = start + timedelta(minutes=request.durationMinutes)
   body = {
     "summary": request.summary or f"Booking for {request.customerName or 'customer'}",
@@ -213,13 +464,28 @@ async def create_booking(request: BookingRequest) -> JSONResponse:
   }
   notes = [request.notes or "", request.transcript or "", request.customerPhone or ""]
   description = "\n\n".join(part for part in notes if part)
+  if len(description) > DESCRIPTION_LIMIT:
+    description = description[: DESCRIPTION_LIMIT - 1] + "…"
   if description:
     body["description"] = description
+  token = await asyncio.get_running_loop().run_in_executor(GCAL_EXEC, calendar_token)
+  url = CALENDAR_EVENTS_URL.format(quote(CALENDAR_ID, safe=""))
   try:
-    event = calendar_service().events().insert(calendarId=CALENDAR_ID, body=body).execute()
-  except HttpError as exc:  # pragma: no cover
+    response = await HTTP.post(
+      url, content=orjson.dumps(body), headers={"Authorization": f"Bearer {token}", **JSON_HEADERS}
+    )
+    response.raise_for_status()
+  except httpx.HTTPStatusError as exc:  # pragma: no cover
+    try:
+      message = exc.response.json().get("error", {}).get("message", "")
+    except ValueError:
+      message = ""
+    LOGGER.error("Calendar insert failed: %s", message or exc)
+    raise HTTPException(status_code=502, detail="Calendar API error") from exc
+  except httpx.HTTPError as exc:  # pragma: no cover
     LOGGER.error("Calendar insert failed: %s", exc)
     raise HTTPException(status_code=502, detail="Calendar API error") from exc
+  event = response.json()
   event_id = str(event.get("id")) if event.get("id") else None
   await fb(
     f"calls/{request.callSid}",
@@ -231,13 +497,19 @@ async def create_booking(request: BookingRequest) -> JSONResponse:
 @app.websocket("/audiostream")
 async def audiostream(websocket: WebSocket) -> None:
   await websocket.accept()
-  stream = CheetahStream()
+  try:
+    engine = await asyncio.wait_for(CHEETAH_POOL.acquire(), timeout=0.5)
+  except asyncio.TimeoutError:
+    LOGGER.warning("Cheetah pool exhausted; rejecting stream")
+    await websocket.close(code=1013, reason="capacity")
+    return
+  stream = CheetahStream(engine)
   session: Optional[CallSession] = None
-  started = datetime.now(timezone.utc)
+  started = time.monotonic()
 
   try:
     while True:
-      message = await websocket.receive_json()
+      message = orjson.loads(await websocket.receive_text())
       event = message.get("event")
       if event == "start":
         start = message.get("start", {})
@@ -266,18 +538,30 @@ async def audiostream(websocket: WebSocket) -> None:
   except WebSocketDisconnect:  # pragma: no cover
     LOGGER.info("WebSocket disconnected by client")
   finally:
-    tail = stream.close()
+    tail = None
+    try:
+      if session:
+        await session.flush_media(stream)
+      tail = stream.close()
+      CHEETAH_POOL.release(engine)
+    except asyncio.CancelledError:
+      asyncio.get_running_loop().create_task(CHEETAH_POOL.recover(stream, engine))
+      raise
+    except Exception as exc:
+      LOGGER.warning("Stream teardown failed: %s", exc)
+      await CHEETAH_POOL.recover(stream, engine)
     if session:
       if tail:
-        session.final = (session.final + " " + tail).strip()
+        session.append_final(tail)
       session.partial = ""
-      await session.push()
+      session.push()
+      session.close_ai()
       await session.push_ai()
-      await fb(
-        f"calls/{session.call_sid}",
+      session.stage(
         {
           "status": "Completed",
           "completedAt": iso_now(),
-          "durationSeconds": int((datetime.now(timezone.utc) - started).total_seconds()),
-        },
+          "durationSeconds": int(time.monotonic() - started),
+        }
       )
+      await session.flush()